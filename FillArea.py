@@ -24,6 +24,10 @@
 from __future__ import print_function
 from pcbnew import *
 import sys
+import os
+import json
+import uuid
+import timeit
 import pprint
 
 """
@@ -60,6 +64,188 @@ class ViaObject:
         size_rect       = wxSize(self.Size+2*max_clearance, self.Size+2*max_clearance)
         return EDA_RECT(start_rect, size_rect)
 
+class ViaRegistry:
+
+    """
+    ViaRegistry keeps track of the vias generated by each stitching run.
+    It is stored in a sidecar file next to the board (<board>.viastitching.json)
+    and maps a run ID to its net, parameters and via positions.
+    """
+
+    VERSION = 1
+
+    def __init__(self, filename=None):
+        self.filename   = filename
+        self.runs       = {}
+        self.Load()
+
+    @staticmethod
+    def GetFilenameForBoard(pcb):
+        if pcb is None or not pcb.GetFileName():
+            return None                                                             # Unsaved board => registry is kept in memory only
+        return os.path.splitext(pcb.GetFileName())[0] + ".viastitching.json"
+
+    def Load(self):
+        if self.filename and os.path.isfile(self.filename):
+            try:
+                with open(self.filename, "r") as f:
+                    data = json.load(f)
+                if data.get("version") == self.VERSION:
+                    self.runs = data.get("runs", {})
+            except (IOError, ValueError):
+                print("Could not read via registry %s, starting with an empty one" % self.filename)
+                self.runs = {}
+        return self
+
+    def Save(self):
+        if self.filename:
+            try:
+                with open(self.filename, "w") as f:
+                    json.dump({"version": self.VERSION, "runs": self.runs}, f, indent=1, sort_keys=True)
+            except IOError as exc:
+                print("Could not write via registry %s: %s" % (self.filename, exc))
+        return self
+
+    def AddRun(self, netname, params, positions):
+        run_id = uuid.uuid4().hex[:12]
+        self.runs[run_id] = {
+            "netname":  netname,
+            "params":   params,
+            "vias":     [[x, y] for (x, y) in positions],
+        }
+        return run_id
+
+    def RemoveRun(self, run_id):
+        self.runs.pop(run_id, None)
+
+    def GetRunIds(self, netname):
+        return [run_id for run_id, run in self.runs.items() if run["netname"] == netname]
+
+    def FindRun(self, netname, params):
+        """
+        Returns the ID of the run with the same net and parameters or None
+        """
+        for run_id in self.GetRunIds(netname):
+            if self.runs[run_id]["params"] == params:
+                return run_id
+        return None
+
+    def GetNetname(self, run_id):
+        if run_id not in self.runs:
+            return None
+        return self.runs[run_id]["netname"]
+
+    def GetPositions(self, run_id):
+        if run_id not in self.runs:
+            return set()
+        return set((x, y) for (x, y) in self.runs[run_id]["vias"])
+
+class FillAreaProfiler:
+
+    """
+    FillAreaProfiler records time and hit-test count per board object (zone, pad, track)
+    and builds a ranked "top offenders" report
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def Record(self, key, elapsed, hit_tests, describe, *describe_args):
+        """
+        key identifies the object and stage, describe(*describe_args) is only called
+        for a new entry to get (kind, description, position)
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            kind, description, position = describe(*describe_args)
+            entry = self.entries[key] = {
+                "kind":         kind,
+                "description":  description,
+                "position":     position,
+                "time":         0.0,
+                "hit_tests":    0,
+                "calls":        0,
+            }
+        entry["time"]       += elapsed
+        entry["hit_tests"]  += hit_tests
+        entry["calls"]      += 1
+
+    def GetReport(self, count=20):
+        ranked      = sorted(self.entries.values(), key=lambda e: e["time"], reverse=True)
+        total_time  = sum(e["time"] for e in ranked)
+        lines = ["Top %d offenders (of %d objects, %.3f s total):" % (min(count, len(ranked)), len(ranked), total_time)]
+        lines.append("%4s %10s %6s %10s %8s  %-22s %-24s %s" % ("#", "time [ms]", "%", "hit tests", "calls", "kind", "position [mm]", "object"))
+        for rank, e in enumerate(ranked[:count]):
+            share = (100.0 * e["time"] / total_time) if total_time else 0.0
+            lines.append("%4d %10.2f %6.1f %10d %8d  %-22s %-24s %s" % (rank + 1, e["time"] * 1000.0, share, e["hit_tests"], e["calls"],
+                                                                      e["kind"], "(%.3f, %.3f)" % e["position"], e["description"]))
+        return "\n".join(lines)
+
+    @staticmethod
+    def DescribeZone(area, stage):
+        bbox = area.GetBoundingBox()
+        return ("Zone (%s)" % stage,
+                "net=%s layer=%s priority=%d corners=%d size=%.3fx%.3fmm" % (area.GetNetname() or "<keepout>", area.GetLayerName(), area.GetPriority(),
+                                                                             area.GetNumCorners(), ToMM(bbox.GetWidth()), ToMM(bbox.GetHeight())),
+                (ToMM(bbox.Centre().x), ToMM(bbox.Centre().y)))
+
+    @staticmethod
+    def DescribePad(pad):
+        return ("Pad",
+                "%s.%s net=%s size=%.3fx%.3fmm" % (pad.GetParent().GetReference(), pad.GetName(), pad.GetNetname(), ToMM(pad.GetSize().x), ToMM(pad.GetSize().y)),
+                (ToMM(pad.GetPosition().x), ToMM(pad.GetPosition().y)))
+
+    @staticmethod
+    def DescribeTrack(track):
+        kind = "Via" if track.Type() == PCB_VIA_T else "Track"
+        return (kind,
+                "net=%s layer=%s width=%.3fmm end=(%.3f, %.3f)" % (track.GetNetname(), track.GetLayerName(), ToMM(track.GetWidth()),
+                                                                  ToMM(track.GetEnd().x), ToMM(track.GetEnd().y)),
+                (ToMM(track.GetStart().x), ToMM(track.GetStart().y)))
+
+class ZoneRefiller:
+
+    """
+    ZoneRefiller refills only the zones touched by added or removed vias.
+    All of them are filled with a single ZONE_FILLER call, which handles the zone
+    priorities and fills the zones of one call in parallel.
+    """
+
+    def __init__(self, pcb, via_size, clearance):
+        self.pcb        = pcb
+        self.via_size   = via_size
+        self.clearance  = clearance
+
+    def GetAffectedZones(self, positions):
+        """
+        Returns the zones (on any layer, vias are through vias) whose outline may contain one of the positions
+        """
+        zones = []
+        for i in range(self.pcb.GetAreaCount()):
+            zone = self.pcb.GetArea(i)
+            if zone.GetIsKeepout():
+                continue
+            margin  = max(zone.GetClearance(), self.clearance) + self.via_size / 2
+            bbox    = zone.GetBoundingBox()
+            x0, y0  = bbox.GetX() - margin, bbox.GetY() - margin
+            x1, y1  = bbox.GetRight() + margin, bbox.GetBottom() + margin
+            for (x, y) in positions:
+                if x0 <= x <= x1 and y0 <= y <= y1:
+                    zones.append(zone)
+                    break
+        return zones
+
+    def FillZones(self, zones):
+        for zone in zones:
+            zone.ClearFilledPolysList()
+            zone.UnFill()
+        
+        try:
+            filler = ZONE_FILLER(self.pcb)
+            filler.Fill(zones)
+        except Exception as exc:
+            print("Could not refill zones, please refill them manually (%s)" % exc)
+
 class FillArea:
 
     """
@@ -87,11 +273,13 @@ class FillArea:
         self.SetOnlyOnSelectedArea(False)
         self.SetDebug(False)
         self.SetStar(True)
+        self.SetProfile(False)
 
     def SetPCB(self, pcb):
         self.pcb = pcb
         if self.pcb is not None:
             self.pcb.BuildListOfNets()
+        self.registry = ViaRegistry(ViaRegistry.GetFilenameForBoard(self.pcb))
         return self
 
     # Set the filename
@@ -99,6 +287,7 @@ class FillArea:
         self.filename = filename
         if self.filename:
             self.SetPCB(LoadBoard(self.filename))
+            self.registry = ViaRegistry()                                           # The board is not saved back => keep the registry in memory only
 
     # Net name to use
     def SetNetname(self, netname):
@@ -137,14 +326,105 @@ class FillArea:
     def SetStar(self, star):
         self.star = star
         return self
+
+    # Record time and hit tests per zone, pad and track and print a "top offenders" report.
+    # The report is also written to report_filename if given.
+    def SetProfile(self, enable, report_filename=None, report_count=20):
+        self.profiler               = FillAreaProfiler() if enable else None
+        self.profile_filename       = report_filename
+        self.profile_report_count   = report_count
+        return self
     
-    def DeleteVias(self):
-        target_tracks = filter(lambda x: (x.GetNetname().upper() == self.netname), self.pcb.GetTracks())
-        for via in target_tracks:
-            if via.Type() == PCB_VIA_T:
-                if via.GetTimeStamp() == 33:
-                    self.pcb.RemoveNative(via)
-        self.RefillBoardAreas()
+    def RefillZonesAt(self, positions):
+        """
+        Refill the zones touched by vias added or removed at the given positions
+        """
+        refiller    = ZoneRefiller(self.pcb, self.size, self.clearance)
+        zones       = refiller.GetAffectedZones(positions)
+        print ("Refilling %d zones..." % len(zones))
+        refiller.FillZones(zones)
+    
+    def GetRunParameters(self, target_areas):
+        """
+        Parameters that identify a stitching run in the via registry
+        With only_selected_area, the selected target areas (layer and outline bbox) are part of it
+        """
+        selected_areas = []
+        if self.only_selected_area:
+            for area in target_areas:
+                if area.IsSelected():
+                    bbox = area.GetBoundingBox()
+                    selected_areas.append([area.GetLayer(), bbox.GetX(), bbox.GetY(), bbox.GetRight(), bbox.GetBottom()])
+        
+        return {
+            "step":                 self.step,
+            "size":                 self.size,
+            "drill":                self.drill,
+            "clearance":            self.clearance,
+            "star":                 self.star,
+            "only_selected_area":   self.only_selected_area,
+            "selected_areas":       sorted(selected_areas),
+        }
+
+    def IsGeneratedVia(self, track, netname):
+        return track.Type() == PCB_VIA_T and track.GetTimeStamp() == 33 and track.GetNetname().upper() == netname
+
+    def GetGeneratedVias(self, netname):
+        """
+        Returns all generated vias of the net on the board, indexed by position
+        """
+        generated_vias = {}
+        for track in self.pcb.GetTracks():
+            if self.IsGeneratedVia(track, netname):
+                generated_vias[(track.GetPosition().x, track.GetPosition().y)] = track
+        return generated_vias
+
+    def RemoveRunVias(self, run_id, generated_vias=None):
+        """
+        Remove the vias of a registered run from the board and the registry
+        generated_vias is the index of GetGeneratedVias for the net of the run, it is built if not given
+        Returns the positions of the removed vias
+        """
+        if generated_vias is None:
+            generated_vias = self.GetGeneratedVias(self.registry.GetNetname(run_id))
+        
+        removed = []
+        missing = []
+        for position in sorted(self.registry.GetPositions(run_id)):
+            via = generated_vias.pop(position, None)
+            if via is not None:
+                self.pcb.RemoveNative(via)
+                removed.append(position)
+            else:
+                missing.append(position)
+        
+        if missing:
+            print ("Warning: %d vias of run %s are no longer on the board:" % (len(missing), run_id))
+            for (x, y) in missing:
+                print ("  (%.3f, %.3f) mm" % (ToMM(x), ToMM(y)))
+        
+        self.registry.RemoveRun(run_id)
+        return removed
+
+    def DeleteVias(self, run_id=None):
+        """
+        Delete all generated vias of the target net, or only those registered for run_id
+        """
+        if run_id is not None:
+            if self.registry.GetNetname(run_id) is None:
+                raise Exception("Unknown run %s!" % run_id)
+            removed = self.RemoveRunVias(run_id)
+        else:
+            # Also catches vias that are not registered (older versions, lost sidecar, command line runs)
+            generated_vias = self.GetGeneratedVias(self.netname)
+            for via in generated_vias.values():
+                self.pcb.RemoveNative(via)
+            removed = list(generated_vias.keys())
+            for rid in self.registry.GetRunIds(self.netname):
+                self.registry.RemoveRun(rid)
+        
+        self.registry.Save()
+        self.RefillZonesAt(removed)
     
     def GetReasonSymbol(self, reason):
         if isinstance(reason, ViaObject):
@@ -188,6 +468,14 @@ DRAWING      = 'D'
 STEP         = '-'
 """)
 
+    def WriteProfileReport(self):
+        report = self.profiler.GetReport(self.profile_report_count)
+        print("\n" + report + "\n")
+        if self.profile_filename:
+            with open(self.profile_filename, "w") as f:
+                f.write(report + "\n")
+            print("Profile report written to %s" % self.profile_filename)
+
     def CheckSelectedArea(self, all_areas):
         if self.only_selected_area:
             selected_areas = filter(lambda x: x.IsSelected(), all_areas)
@@ -206,22 +494,68 @@ STEP         = '-'
         self.pcb.Add(m)
     
     def RefillBoardAreas(self):
-        for i in range(self.pcb.GetAreaCount()):
-            area = self.pcb.GetArea(i)
-            if not area.GetIsKeepout():
-                area.ClearFilledPolysList()
-                area.UnFill()
-        
-        try:
-            filler = ZONE_FILLER(self.pcb)
-            filler.Fill(self.pcb.Zones())
-        except:
-            pass
+        all_zones = [self.pcb.GetArea(i) for i in range(self.pcb.GetAreaCount())]
+        ZoneRefiller(self.pcb, self.size, self.clearance).FillZones([zone for zone in all_zones if not zone.GetIsKeepout()])
     
+    def HitTestViaInArea(self, via, area):
+        '''
+        Checks if a Via touches the area
+        Returns the result and the number of hit tests done
+        '''
+        if area.HitTest(via.GetHitTestRectangle(area.GetClearance()), False):
+            return True, 1
+        return area.HitTestInsideZone(via.CenterPoint), 2
+
+    def CheckViaInArea(self, via, area, all_areas):
+        '''
+        Checks if an existing Via collides with the given area (profiled path)
+        Returns the reason and the number of hit tests done
+        '''
+        area_layer          = area.GetLayer()
+        area_priority       = area.GetPriority()
+        is_keepout_area     = area.GetIsKeepout()
+        is_target_net       = (area.GetNetname().upper() == self.netname)
+        hit_tests           = 0
+
+        if (not is_target_net):                                                         # Only process areas that are not in the target net
+            hit, count  = self.HitTestViaInArea(via, area)
+            hit_tests  += count
+            if hit:
+                if is_keepout_area: 
+                    return self.REASON_KEEPOUT, hit_tests                               # Collides with keepout
+                else:
+                    # Check if the zone is higher priority than other zones of the target net in the same point
+                    target_areas_on_same_layer = filter(lambda x: ((x.GetPriority() > area_priority) and (x.GetLayer() == area_layer) and (x.GetNetname().upper() == self.netname)), all_areas)
+                    for area_with_higher_priority in target_areas_on_same_layer:
+                        hit, count  = self.HitTestViaInArea(via, area_with_higher_priority)
+                        hit_tests  += count
+                        if hit:
+                            break                                                       # Area of target net has higher priority on this layer
+                    else:
+                        return self.REASON_OTHER_SIGNAL, hit_tests                      # Collides with another signal (e.g. on another layer)
+        
+        return self.REASON_OK, hit_tests
+
+    def CheckViaInAllAreasProfiled(self, via, all_areas):
+        '''
+        Same as CheckViaInAllAreas, but records time and hit tests per area
+        '''
+        for index, area in enumerate(all_areas):
+            start_time = timeit.default_timer()
+            reason, hit_tests = self.CheckViaInArea(via, area, all_areas)
+            self.profiler.Record(("zone_check", index), timeit.default_timer() - start_time, hit_tests, FillAreaProfiler.DescribeZone, area, "via check")
+            if reason != self.REASON_OK:
+                return reason
+        
+        return self.REASON_OK
+
     def CheckViaInAllAreas(self, via, all_areas):
         '''
         Checks if an existing Via collides with another area
         '''
+        if self.profiler:
+            return self.CheckViaInAllAreasProfiled(via, all_areas)
+        
         # Enum all area
         for area in all_areas:
             area_layer          = area.GetLayer()
@@ -296,6 +630,12 @@ STEP         = '-'
         
         self.CheckSelectedArea(all_areas)
         
+        # A previous run with identical parameters is replaced, so its vias must not block the new ones
+        run_params      = self.GetRunParameters(target_areas)
+        previous_run_id = self.registry.FindRun(self.netname, run_params)
+        previous_vias   = self.registry.GetPositions(previous_run_id)
+        generated_vias  = self.GetGeneratedVias(self.netname) if previous_run_id is not None else {}
+        
         lboard = self.pcb.ComputeBoundingBox(True)
         origin = lboard.GetPosition()
 
@@ -309,7 +649,7 @@ STEP         = '-'
         max_target_area_clearance = 0
         
         # Enum all target areas (Search possible positions for vias on the target net)
-        for area in target_areas:
+        for index, area in enumerate(target_areas):
             print ("Processing Target Area: %s, LayerName: %s..." % (area.GetNetname(), area.GetLayerName()))
             
             is_selected_area    = area.IsSelected()
@@ -318,6 +658,10 @@ STEP         = '-'
                 max_target_area_clearance = area_clearance
             
             if (not self.only_selected_area) or (self.only_selected_area and is_selected_area):         # All areas or only the selected area
+                if self.profiler:
+                    hit_tests   = 12 * sum(column.count(self.REASON_NO_SIGNAL) for column in rectangle)  # 3 hit tests on 4 corners of every free point
+                    start_time  = timeit.default_timer()
+                
                 for x in range(len(rectangle)):                                                         # Check every possible point in the virtual coordinate system
                     for y in range(len(rectangle[0])):
                         if rectangle[x][y] == self.REASON_NO_SIGNAL:                                    # No other "target area" found yet => go on with processing
@@ -339,6 +683,9 @@ STEP         = '-'
                             if test_result:
                                 via_obj = ViaObject(pos_x=current_x, pos_y=current_y, size=self.size, clearance=max(self.clearance, area_clearance), target_net=target_net)         # Create a via object with information about the via and place it in the rectangle
                                 rectangle[x][y] = via_obj
+                
+                if self.profiler:
+                    self.profiler.Record(("zone_target", index), timeit.default_timer() - start_time, hit_tests, FillAreaProfiler.DescribeZone, area, "target scan")
         
         if self.debug:
             print("\nPost target areas:")
@@ -359,7 +706,10 @@ STEP         = '-'
         
         # Same job with all pads => all pads on all layers
         print ("Processing all pads...")
-        for pad in all_pads:
+        for index, pad in enumerate(all_pads):
+            if self.profiler:
+                start_time = timeit.default_timer()
+            
             local_offset = max(pad.GetClearance(), self.clearance, max_target_area_clearance) + (self.size / 2)
             max_size     = max(pad.GetSize().x, pad.GetSize().y)
             
@@ -381,6 +731,17 @@ STEP         = '-'
             if stop_y > y_limit-1:
                 stop_y = y_limit-1
             
+            if self.profiler:
+                hit_tests = 0
+                for x in range(start_x, stop_x + 1):
+                    for y in range(start_y, stop_y + 1):
+                        if isinstance(rectangle[x][y], ViaObject):
+                            hit_tests += 1
+                            if pad.HitTest(rectangle[x][y].GetHitTestRectangle(pad.GetClearance()), False):
+                                rectangle[x][y] = self.REASON_PAD
+                self.profiler.Record(("pad", index), timeit.default_timer() - start_time, hit_tests, FillAreaProfiler.DescribePad, pad)
+                continue
+            
             for x in range(start_x, stop_x + 1):
                 for y in range(start_y, stop_y + 1):
                     if isinstance(rectangle[x][y], ViaObject):
@@ -393,7 +754,13 @@ STEP         = '-'
         
         # Same job with tracks => all tracks on all layers
         print ("Processing all tracks...")
-        for track in all_tracks:
+        for index, track in enumerate(all_tracks):
+            if (track.GetPosition().x, track.GetPosition().y) in previous_vias and self.IsGeneratedVia(track, self.netname):
+                continue                                                                # Generated by the run being replaced
+            
+            if self.profiler:
+                start_time = timeit.default_timer()
+            
             start_x = track.GetStart().x
             start_y = track.GetStart().y
 
@@ -430,6 +797,17 @@ STEP         = '-'
             if stop_y > y_limit-1:
                 stop_y = y_limit-1
             
+            if self.profiler:
+                hit_tests = 0
+                for x in range(start_x, stop_x + 1):
+                    for y in range(start_y, stop_y + 1):
+                        if isinstance(rectangle[x][y], ViaObject):
+                            hit_tests += 1
+                            if track.HitTest(rectangle[x][y].GetHitTestRectangle((track.GetWidth()/2)+track.GetClearance()), False):
+                                rectangle[x][y] = self.REASON_TRACK
+                self.profiler.Record(("track", index), timeit.default_timer() - start_time, hit_tests, FillAreaProfiler.DescribeTrack, track)
+                continue
+            
             for x in range(start_x, stop_x + 1):
                 for y in range(start_y, stop_y + 1):
                     if isinstance(rectangle[x][y], ViaObject):
@@ -477,19 +855,45 @@ STEP         = '-'
         if self.step != 0:
             clear_distance = ((self.step+l_clearance) // l_clearance)       # How much "via steps" should be removed around a via (round up)
         
+        accepted_vias = []
         for x in range(len(rectangle)):
             for y in range(len(rectangle[0])):
                 if isinstance(rectangle[x][y], ViaObject):
                     if clear_distance:
                         self.ClearViaInStepSize(rectangle, x, y, clear_distance)
                     
-                    self.AddVia(rectangle[x][y])
+                    accepted_vias.append(rectangle[x][y])
         
         if self.debug:
             print("\nFinal result:")
             self.PrintRect(rectangle)
 
-        self.RefillBoardAreas()
+        if self.profiler:
+            self.WriteProfileReport()
+
+        accepted_positions = set((via.PosX, via.PosY) for via in accepted_vias)
+        if previous_run_id is not None:
+            missing_vias = previous_vias.difference(generated_vias)
+            if missing_vias:
+                print ("%d vias of run %s are missing on the board (undo or manual edit?), adding them again" % (len(missing_vias), previous_run_id))
+            elif accepted_positions == previous_vias:
+                print ("Vias of run %s are unchanged, nothing to do" % previous_run_id)
+                print ("Done!")
+                return
+            
+            print ("Replacing vias of run %s..." % previous_run_id)
+            removed_positions = self.RemoveRunVias(previous_run_id, generated_vias)
+        else:
+            removed_positions = []
+        
+        for via in accepted_vias:
+            self.AddVia(via)
+        
+        run_id = self.registry.AddRun(self.netname, run_params, sorted(accepted_positions))
+        self.registry.Save()
+        print ("Registered %d vias as run %s" % (len(accepted_vias), run_id))
+
+        self.RefillZonesAt(list(accepted_positions) + removed_positions)
 
         print ("Done!")
 